@@ -1,5 +1,9 @@
+import asyncio
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 from pathlib import Path
 
 from aiohttp import web
@@ -10,7 +14,12 @@ from dotenv import load_dotenv
 from ragtools import attach_rag_tools
 from rtmt import RTMiddleTier
 
-logging.basicConfig(level=logging.INFO)
+# Records are written out by a background thread, so a slow stdout never stalls the event loop
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger("voicerag")
 
 async def create_app():
@@ -70,7 +79,16 @@ async def create_app():
     
     return app
 
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    try:
+        # The middle tier is pure websocket forwarding, which runs noticeably faster on uvloop
+        import uvloop
+        return uvloop.new_event_loop()
+    except ImportError:
+        # uvloop isn't available on Windows, stick with the default asyncio event loop there
+        return asyncio.new_event_loop()
+
 if __name__ == "__main__":
     host = "localhost"
     port = 8765
-    web.run_app(create_app(), host=host, port=port)
+    web.run_app(create_app(), host=host, port=port, loop=new_event_loop())
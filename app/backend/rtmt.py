@@ -1,42 +1,122 @@
 import asyncio
-import json
 import logging
+import re
+import time
+from collections import deque
+from collections.abc import Awaitable
 from enum import Enum
 from typing import Any, Callable, Optional
 
 import aiohttp
+import orjson
 from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity import DefaultAzureCredential
 
 logger = logging.getLogger("voicerag")
 
+_TOKEN_SCOPE = "https://cognitiveservices.azure.com/.default"
+# Tokens are renewed this many seconds before they expire, but never more often than the minimum interval
+_TOKEN_REFRESH_MARGIN = 600
+_TOKEN_MIN_REFRESH_INTERVAL = 60
+
+_REALTIME_PATH = "/openai/realtime"
+
+# Applied to both the client and the upstream socket. aiohttp already turns on TCP_NODELAY for both, the
+# heartbeat makes sure a dead peer on either side tears the pair down instead of leaving it hanging
+_WS_MAX_MSG_SIZE = 4 * 1024 * 1024
+_WS_HEARTBEAT = 20
+# Offer permessage-deflate (max window bits) upstream; it's only used if the endpoint accepts it. The client-facing
+# WebSocketResponse negotiates it by default already
+_WS_COMPRESS = 15
+
+def _dumps(obj: Any) -> str:
+    # aiohttp's send_str wants str, orjson produces utf-8 bytes
+    return orjson.dumps(obj).decode()
+
+# Sent after every round of tool calls, it never changes so it's only serialized once
+_RESPONSE_CREATE = _dumps({"type": "response.create"})
+
+# Hide the instructions, tools and max tokens from clients, if we ever allow client-side 
+# tools, this will need updating
+_HIDDEN_SESSION_FIELDS = {
+    "instructions": "",
+    "tools": [],
+    "tool_choice": "none",
+    "max_response_output_tokens": None
+}
+
+_FUNCTION_CALL = "function_call"
+_FUNCTION_CALL_OUTPUT = "function_call_output"
+
+# Results of identical tool calls are reused for this many seconds, across all connections
+_TOOL_CACHE_TTL = 60.0
+_TOOL_CACHE_MAX_ENTRIES = 512
+
+# Function call arguments that don't need parsing
+_EMPTY_ARGUMENTS = ("", "{}")
+
+# Anchored at the start of the frame so a nested "type" (e.g. an item's) can never be picked up
+_TYPE_PATTERN = re.compile(r'\{\s*"type"\s*:\s*"([^"\\]*)"')
+
+# Audio frames are by far the most frequent and carry large base64 payloads, check for them
+# with a single startswith before doing anything else
+_CLIENT_AUDIO_PREFIXES = ('{"type":"response.audio.delta"', '{"type":"response.audio_transcript.delta"')
+_SERVER_AUDIO_PREFIXES = ('{"type":"input_audio_buffer.append"',)
+
+# Transcript deltas still queued for a slow client are merged into one frame, the audio deltas can't be
+# (their base64 chunks aren't safe to concatenate)
+_TRANSCRIPT_DELTA_PREFIXES = ('{"type":"response.audio_transcript.delta"', '{"type": "response.audio_transcript.delta"')
+# How many frames may wait for the client before we stop reading from the upstream socket, and the other way
+# around. Stops a slow peer on either side from growing the queues without limit
+_CLIENT_MAX_PENDING = 64
+_SERVER_MAX_PENDING = 64
+
+def _peek_type(data: str) -> Optional[str]:
+    # Realtime events carry "type" as their first key; if a frame doesn't look like that, return None
+    # and let the caller fall back to a full parse
+    match = _TYPE_PATTERN.match(data)
+    return match.group(1) if match is not None else None
+
 class ToolResultDirection(Enum):
     TO_SERVER = 1
     TO_CLIENT = 2
 
 class ToolResult:
+    __slots__ = ("text", "destination", "_text_cache")
     text: str
     destination: ToolResultDirection
+    _text_cache: Optional[str]
 
     def __init__(self, text: str, destination: ToolResultDirection):
         self.text = text
         self.destination = destination
+        self._text_cache = None
 
     def to_text(self) -> str:
-        if self.text is None:
-            return ""
-        return self.text if type(self.text) == str else json.dumps(self.text)
+        # Results such as search hits can be several KB, serialize them once no matter how often they're sent
+        if self._text_cache is None:
+            if self.text is None:
+                self._text_cache = ""
+            else:
+                # Tools hand back arbitrary structures, allow non-string keys like the stdlib json module does
+                self._text_cache = self.text if isinstance(self.text, str) else orjson.dumps(self.text, option=orjson.OPT_NON_STR_KEYS).decode()
+        return self._text_cache
 
 class Tool:
+    __slots__ = ("target", "schema", "has_arguments")
     target: Callable[..., ToolResult]
     schema: Any
+    has_arguments: bool
 
     def __init__(self, target: Any, schema: Any):
         self.target = target
         self.schema = schema
+        # Tools without any declared parameters always get an empty argument dict, no need to parse it
+        self.has_arguments = bool(schema.get("parameters", {}).get("properties"))
 
 class RTToolCall:
+    __slots__ = ("tool_call_id", "previous_id")
     tool_call_id: str
     previous_id: str
 
@@ -44,185 +124,478 @@ class RTToolCall:
         self.tool_call_id = tool_call_id
         self.previous_id = previous_id
 
+# Queues outgoing frames for a websocket and sends them from a single drain task, so bursts go out back-to-back.
+# Producers only wait (in wait_for_room) once max_pending frames are queued, and once the drain task has stopped
+# they get its error, or ConnectionResetError after a close, instead of queueing frames nobody will send
+class RTWebSocketWriter:
+    def __init__(self, ws: web.WebSocketResponse | aiohttp.ClientWebSocketResponse, max_pending: Optional[int] = None):
+        self._ws = ws
+        self._queue: deque[str] = deque()
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._max_pending = max_pending
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._drain())
+
+    def send_str(self, data: str) -> None:
+        self._raise_if_stopped()
+        self._queue.append(data)
+        self._ready.set()
+        if self._max_pending is not None and len(self._queue) >= self._max_pending:
+            self._room.clear()
+
+    def send_json(self, data: Any) -> None:
+        self.send_str(_dumps(data))
+
+    async def wait_for_room(self) -> None:
+        # Back-pressure for the reader feeding this writer, returns right away unless the queue is full
+        if not self._room.is_set():
+            await self._room.wait()
+        self._raise_if_stopped()
+
+    async def close(self) -> None:
+        # Flushes whatever is still queued, then stops the drain task
+        self._closing = True
+        self._ready.set()
+        if self._task is not None:
+            await self._task
+
+    def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def _raise_if_stopped(self) -> None:
+        task = self._task
+        if task is not None and task.done():
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+            raise ConnectionResetError("Websocket writer is closed")
+
+    async def _drain(self) -> None:
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self._queue:
+                    data = self._queue.popleft()
+                    if self._queue and data.startswith(_TRANSCRIPT_DELTA_PREFIXES):
+                        data = self._coalesce_transcript_deltas(data)
+                    if not self._room.is_set() and len(self._queue) < self._max_pending:
+                        self._room.set()
+                    await self._ws.send_str(data)
+                if self._closing:
+                    return
+        finally:
+            # Never leave the reader blocked on a writer that is gone
+            self._room.set()
+
+    def _coalesce_transcript_deltas(self, data: str) -> str:
+        # The socket fell behind, merge the queued transcript deltas of the same content part into a single frame
+        message = orjson.loads(data)
+        key = (message.get("response_id"), message.get("item_id"), message.get("content_index"))
+        deltas = [message["delta"]]
+        while self._queue and self._queue[0].startswith(_TRANSCRIPT_DELTA_PREFIXES):
+            following = orjson.loads(self._queue[0])
+            if (following.get("response_id"), following.get("item_id"), following.get("content_index")) != key:
+                break
+            deltas.append(following["delta"])
+            self._queue.popleft()
+        if len(deltas) == 1:
+            return data
+        message["delta"] = "".join(deltas)
+        return _dumps(message)
+
+# State for a single client connection and its upstream realtime socket
+class RTConnection:
+    __slots__ = ("client_ws", "server_ws", "tools_pending", "tool_tasks")
+    client_ws: RTWebSocketWriter
+    server_ws: RTWebSocketWriter
+    tools_pending: dict[str, RTToolCall]
+    tool_tasks: set[asyncio.Task]
+
+    def __init__(self, client_ws: RTWebSocketWriter, server_ws: RTWebSocketWriter):
+        self.client_ws = client_ws
+        self.server_ws = server_ws
+        self.tools_pending = {}
+        self.tool_tasks = set()
+
+    def run_tool_task(self, coro: Awaitable[None]) -> None:
+        task = asyncio.create_task(coro)
+        self.tool_tasks.add(task)
+        task.add_done_callback(self._tool_task_done)
+
+    def _tool_task_done(self, task: asyncio.Task) -> None:
+        self.tool_tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        if isinstance(task.exception(), ConnectionResetError):
+            # The connection went away while the tool was running, there's nobody to send the result to
+            logger.debug("Dropped tool output for a closed connection")
+        else:
+            logger.error("Tool task failed", exc_info=task.exception())
+
+    def cancel(self) -> None:
+        self.client_ws.cancel()
+        self.server_ws.cancel()
+        for task in list(self.tool_tasks):
+            task.cancel()
+
 class RTMiddleTier:
+    __slots__ = ("endpoint", "deployment", "key", "tools", "model", "system_message", "temperature", "max_tokens",
+                 "disable_audio", "voice_choice", "api_version", "_credentials", "_token", "_token_expires_on",
+                 "_session_overrides", "_client_session", "_client_handlers", "_server_handlers",
+                 "_tool_cache", "_key_headers", "_upstream_params")
     endpoint: str
     deployment: str
-    key: Optional[str] = None
+    key: Optional[str]
     
     # Tools are server-side only for now, though the case could be made for client-side tools
     # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
+    tools: dict[str, Tool]
 
     # Server-enforced configuration, if set, these will override the client's configuration
     # Typically at least the model name and system message will be set by the server
-    model: Optional[str] = None
-    system_message: Optional[str] = None
-    temperature: Optional[float] = None
-    max_tokens: Optional[int] = None
-    disable_audio: Optional[bool] = None
-    voice_choice: Optional[str] = None
-    api_version: str = "2024-10-01-preview"
-    _tools_pending = {}
-    _token_provider = None
+    model: Optional[str]
+    system_message: Optional[str]
+    temperature: Optional[float]
+    max_tokens: Optional[int]
+    disable_audio: Optional[bool]
+    voice_choice: Optional[str]
+    api_version: str
+    _credentials: Optional[DefaultAzureCredential]
+    _token: Optional[str]
+    _token_expires_on: float
+    _session_overrides: Optional[dict[str, Any]]
+    _client_session: Optional[aiohttp.ClientSession]
+    _client_handlers: dict[str, Callable[..., Awaitable[Optional[str]]]]
+    _server_handlers: dict[str, Callable[..., Awaitable[Optional[str]]]]
+    _tool_cache: dict[tuple[str, str], tuple[float, ToolResult]]
+    _key_headers: Optional[dict[str, str]]
+    _upstream_params: Optional[dict[str, str]]
 
     def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None):
         self.endpoint = endpoint
         self.deployment = deployment
+        self.key = None
+        self.tools = {}
+        self.model = None
+        self.system_message = None
+        self.temperature = None
+        self.max_tokens = None
+        self.disable_audio = None
         self.voice_choice = voice_choice
+        self.api_version = "2024-10-01-preview"
+        self._credentials = None
+        self._token = None
+        self._token_expires_on = 0
+        self._session_overrides = None
+        self._client_session = None
+        self._tool_cache = {}
+        self._key_headers = None
+        self._upstream_params = None
+        # Only these message types are ever rewritten or dropped, everything else (audio and transcript
+        # deltas make up most of the traffic) is forwarded untouched
+        self._client_handlers = {
+            "session.created": self._on_session_created,
+            "response.output_item.added": self._on_output_item_added,
+            "conversation.item.created": self._on_conversation_item_created,
+            "response.function_call_arguments.delta": self._drop_message,
+            "response.function_call_arguments.done": self._drop_message,
+            "response.output_item.done": self._on_output_item_done,
+            "response.done": self._on_response_done
+        }
+        self._server_handlers = {
+            "session.update": self._on_session_update
+        }
         if voice_choice is not None:
             logger.info("Realtime voice choice set to %s", voice_choice)
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
+            self._key_headers = { "api-key": self.key }
         else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
-
-    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
-        updated_message = msg.data
-        if message is not None:
-            match message["type"]:
-                case "session.created":
-                    session = message["session"]
-                    # Hide the instructions, tools and max tokens from clients, if we ever allow client-side 
-                    # tools, this will need updating
-                    session["instructions"] = ""
-                    session["tools"] = []
-                    session["voice"] = self.voice_choice
-                    session["tool_choice"] = "none"
-                    session["max_response_output_tokens"] = None
-                    updated_message = json.dumps(message)
-
-                case "response.output_item.added":
-                    if "item" in message and message["item"]["type"] == "function_call":
-                        updated_message = None
-
-                case "conversation.item.created":
-                    if "item" in message and message["item"]["type"] == "function_call":
-                        item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
-                        updated_message = None
-                    elif "item" in message and message["item"]["type"] == "function_call_output":
-                        updated_message = None
-
-                case "response.function_call_arguments.delta":
-                    updated_message = None
-                
-                case "response.function_call_arguments.done":
-                    updated_message = None
-
-                case "response.output_item.done":
-                    if "item" in message and message["item"]["type"] == "function_call":
-                        item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        result = await tool.target(json.loads(args))
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # TODO: this will break clients that don't know about this extra message, rewrite 
-                            # this to be a regular text message with a special marker of some sort
-                            await client_ws.send_json({
-                                "type": "extension.middle_tier_tool_response",
-                                "previous_item_id": tool_call.previous_id,
-                                "tool_name": item["name"],
-                                "tool_result": result.to_text()
-                            })
-                        updated_message = None
-
-                case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear() # Any chance tool calls could be interleaved across different outstanding responses?
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
-                    if "response" in message:
-                        replace = False
-                        for i, output in enumerate(reversed(message["response"]["output"])):
-                            if output["type"] == "function_call":
-                                message["response"]["output"].pop(i)
-                                replace = True
-                        if replace:
-                            updated_message = json.dumps(message)                        
-
-        return updated_message
+            self._credentials = credentials
+            self._refresh_token() # Warm up during startup so we have a token cached when the first request arrives
+
+    def _refresh_token(self) -> str:
+        access_token = self._credentials.get_token(_TOKEN_SCOPE)
+        self._token = access_token.token
+        self._token_expires_on = access_token.expires_on
+        return self._token
+
+    def _get_token(self) -> str:
+        # Normally the refresh task keeps the cached token fresh, this only blocks if it fell behind
+        if time.time() >= self._token_expires_on - _TOKEN_REFRESH_MARGIN:
+            return self._refresh_token()
+        return self._token
+
+    async def _refresh_token_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(max(self._token_expires_on - _TOKEN_REFRESH_MARGIN - time.time(), _TOKEN_MIN_REFRESH_INTERVAL))
+            try:
+                # get_token is synchronous and may hit the network, keep it off the event loop
+                await loop.run_in_executor(None, self._refresh_token)
+            except Exception:
+                logger.exception("Failed to refresh the Azure OpenAI token")
+
+    async def _token_refresh_ctx(self, app: web.Application):
+        task = asyncio.create_task(self._refresh_token_periodically())
+        yield
+        task.cancel()
+
+    def _get_session_overrides(self) -> dict[str, Any]:
+        # Tools and server-enforced settings are in place before the first client connects and don't
+        # change afterwards, so the overrides are built once and reused for every session.update
+        if self._session_overrides is None:
+            overrides = {
+                "instructions": self.system_message,
+                "temperature": self.temperature,
+                "max_response_output_tokens": self.max_tokens,
+                "disable_audio": self.disable_audio,
+                "voice": self.voice_choice
+            }
+            overrides = {k: v for k, v in overrides.items() if v is not None}
+            overrides["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
+            # The schemas are nested dicts that never change, embed them pre-serialized so dumping the
+            # message doesn't walk them again every time
+            overrides["tools"] = orjson.Fragment(orjson.dumps([tool.schema for tool in self.tools.values()]))
+            self._session_overrides = overrides
+        return self._session_overrides
+
+    # Message handlers get the raw frame and its parsed form, and return what to forward: the raw frame
+    # if nothing changed, a re-serialized message if they modified it, or None to drop it
+    async def _on_session_created(self, data: str, message: dict[str, Any], conn: RTConnection) -> Optional[str]:
+        session = message["session"]
+        session.update(_HIDDEN_SESSION_FIELDS)
+        session["voice"] = self.voice_choice
+        return _dumps(message)
+
+    async def _on_output_item_added(self, data: str, message: dict[str, Any], conn: RTConnection) -> Optional[str]:
+        item = message.get("item")
+        if item is not None and item["type"] == _FUNCTION_CALL:
+            return None
+        return data
+
+    async def _on_conversation_item_created(self, data: str, message: dict[str, Any], conn: RTConnection) -> Optional[str]:
+        item = message.get("item")
+        item_type = item["type"] if item is not None else None
+        if item_type == _FUNCTION_CALL:
+            if item["call_id"] not in conn.tools_pending:
+                conn.tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+            return None
+        elif item_type == _FUNCTION_CALL_OUTPUT:
+            return None
+        return data
+
+    async def _drop_message(self, data: str, message: dict[str, Any], conn: RTConnection) -> Optional[str]:
+        return None
+
+    async def _on_output_item_done(self, data: str, message: dict[str, Any], conn: RTConnection) -> Optional[str]:
+        item = message.get("item")
+        if item is not None and item["type"] == _FUNCTION_CALL:
+            tool_call = conn.tools_pending.get(item["call_id"])
+            tool = self.tools.get(item["name"])
+            if tool_call is None or tool is None:
+                # A stale call id or a tool we don't have, drop it rather than tear the whole session down
+                logger.warning("Unknown tool call %s (%s)", item.get("call_id"), item.get("name"))
+                return None
+            # Tools can take a while (e.g. a search round-trip), run them in the background so the server
+            # to client pump keeps forwarding frames in the meantime
+            conn.run_tool_task(self._run_tool(tool, tool_call, item, conn))
+            return None
+        return data
+
+    async def _call_tool(self, name: str, tool: Tool, args: str) -> ToolResult:
+        # Users often ask the same thing again or rephrase it into the same query, reuse recent results for
+        # identical calls instead of going back to the search service. The raw arguments string is the key
+        key = (name, args)
+        now = time.monotonic()
+        cached = self._tool_cache.get(key)
+        if cached is not None and now - cached[0] < _TOOL_CACHE_TTL:
+            return cached[1]
+        result = await tool.target(orjson.loads(args) if tool.has_arguments and args not in _EMPTY_ARGUMENTS else {})
+        self._tool_cache.pop(key, None)
+        if len(self._tool_cache) >= _TOOL_CACHE_MAX_ENTRIES:
+            # Dicts keep insertion order, so the first entry is the oldest one
+            del self._tool_cache[next(iter(self._tool_cache))]
+        self._tool_cache[key] = (now, result)
+        return result
+
+    async def _run_tool(self, tool: Tool, tool_call: RTToolCall, item: dict[str, Any], conn: RTConnection):
+        try:
+            result = await self._call_tool(item["name"], tool, item["arguments"])
+        except Exception as e:
+            # Still answer the call, otherwise the model would wait for an output that never comes
+            logger.exception("Tool %s failed", item["name"])
+            result = ToolResult(f"tool error: {e}", ToolResultDirection.TO_SERVER)
+        conn.server_ws.send_json({
+            "type": "conversation.item.create",
+            "item": {
+                "type": _FUNCTION_CALL_OUTPUT,
+                "call_id": item["call_id"],
+                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
+            }
+        })
+        if result.destination == ToolResultDirection.TO_CLIENT:
+            # TODO: this will break clients that don't know about this extra message, rewrite 
+            # this to be a regular text message with a special marker of some sort
+            conn.client_ws.send_json({
+                "type": "extension.middle_tier_tool_response",
+                "previous_item_id": tool_call.previous_id,
+                "tool_name": item["name"],
+                "tool_result": result.to_text()
+            })
+
+    async def _create_response_after_tools(self, tool_tasks: list[asyncio.Task], conn: RTConnection):
+        # The next response must only be requested once every tool output has been sent upstream
+        if len(tool_tasks) > 0:
+            await asyncio.wait(tool_tasks)
+        conn.server_ws.send_str(_RESPONSE_CREATE)
+
+    async def _on_response_done(self, data: str, message: dict[str, Any], conn: RTConnection) -> Optional[str]:
+        if len(conn.tools_pending) > 0:
+            conn.tools_pending.clear() # Any chance tool calls could be interleaved across different outstanding responses?
+            conn.run_tool_task(self._create_response_after_tools(list(conn.tool_tasks), conn))
+        if "response" in message:
+            outputs = message["response"]["output"]
+            filtered = [output for output in outputs if output.get("type") != _FUNCTION_CALL]
+            if len(filtered) != len(outputs):
+                message["response"]["output"] = filtered
+                return _dumps(message)
+        return data
+
+    async def _on_session_update(self, data: str, message: dict[str, Any]) -> Optional[str]:
+        message["session"].update(self._get_session_overrides())
+        return _dumps(message)
+
+    async def _process_message_to_client(self, msg: str, conn: RTConnection) -> Optional[str]:
+        data = msg.data
+        if data.startswith(_CLIENT_AUDIO_PREFIXES):
+            return data
+        # Frames with a type we have no handler for are forwarded as-is, without parsing them
+        mtype = _peek_type(data)
+        if mtype is not None and mtype not in self._client_handlers:
+            return data
+        if mtype == "response.done" and len(conn.tools_pending) == 0 and '"function_call"' not in data:
+            # No tool calls to follow up on and nothing to strip from the output
+            return data
+        message = orjson.loads(data)
+        if message is None:
+            return data
+        handler = self._client_handlers.get(message["type"])
+        return await handler(data, message, conn) if handler is not None else data
 
     async def _process_message_to_server(self, msg: str, ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
-        updated_message = msg.data
-        if message is not None:
-            match message["type"]:
-                case "session.update":
-                    session = message["session"]
-                    if self.system_message is not None:
-                        session["instructions"] = self.system_message
-                    if self.temperature is not None:
-                        session["temperature"] = self.temperature
-                    if self.max_tokens is not None:
-                        session["max_response_output_tokens"] = self.max_tokens
-                    if self.disable_audio is not None:
-                        session["disable_audio"] = self.disable_audio
-                    if self.voice_choice is not None:
-                        session["voice"] = self.voice_choice
-                    session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
-                    session["tools"] = [tool.schema for tool in self.tools.values()]
-                    updated_message = json.dumps(message)
-
-        return updated_message
+        data = msg.data
+        if data.startswith(_SERVER_AUDIO_PREFIXES):
+            return data
+        mtype = _peek_type(data)
+        if mtype is not None and mtype not in self._server_handlers:
+            return data
+        message = orjson.loads(data)
+        if message is None:
+            return data
+        handler = self._server_handlers.get(message["type"])
+        return await handler(data, message) if handler is not None else data
+
+    async def _client_session_ctx(self, app: web.Application):
+        # Configuration is final by the time the app starts, the query string is the same for every connection
+        self._upstream_params = { "api-version": self.api_version, "deployment": self.deployment }
+        # One session for the whole process so connections to the realtime endpoint share the connector,
+        # DNS cache and TLS context instead of setting them up again for every client
+        self._client_session = aiohttp.ClientSession(
+            base_url=self.endpoint,
+            connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=60))
+        yield
+        await self._client_session.close()
+
+    async def _from_client_to_server(self, ws: web.WebSocketResponse, target_ws: aiohttp.ClientWebSocketResponse, conn: RTConnection):
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                # An ERROR frame (e.g. one over _WS_MAX_MSG_SIZE) means the socket is about to close, say why
+                if msg.type == aiohttp.WSMsgType.ERROR:
+                    logger.warning("Error on the client socket: %s", ws.exception())
+                else:
+                    logger.warning("Unexpected message type from client: %s", msg.type)
+                continue
+            new_msg = await self._process_message_to_server(msg, ws)
+            if new_msg is not None:
+                conn.server_ws.send_str(new_msg)
+                await conn.server_ws.wait_for_room()
+        
+        # Means it is gracefully closed by the client then time to close the target_ws
+        await conn.server_ws.close()
+        if target_ws:
+            logger.debug("Closing OpenAI's realtime socket connection")
+            await target_ws.close()
+
+    async def _from_server_to_client(self, ws: web.WebSocketResponse, target_ws: aiohttp.ClientWebSocketResponse, conn: RTConnection):
+        async for msg in target_ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                # An ERROR frame (e.g. one over _WS_MAX_MSG_SIZE) means the socket is about to close, say why
+                if msg.type == aiohttp.WSMsgType.ERROR:
+                    logger.warning("Error on the server socket: %s", target_ws.exception())
+                else:
+                    logger.warning("Unexpected message type from server: %s", msg.type)
+                continue
+            new_msg = await self._process_message_to_client(msg, conn)
+            if new_msg is not None:
+                conn.client_ws.send_str(new_msg)
+                await conn.client_ws.wait_for_room()
+
+        # The realtime socket is gone, close the client socket too so the other pump ends instead of
+        # waiting for the client to hang up
+        await conn.client_ws.close()
+        logger.debug("Closing the client socket connection")
+        await ws.close()
+
+    def _upstream_headers(self) -> dict[str, str]:
+        # Only the bearer token can change between connections
+        if self._key_headers is not None:
+            return self._key_headers
+        return { "Authorization": f"Bearer {self._get_token()}" }
+
+    async def _connect_upstream(self) -> aiohttp.ClientWebSocketResponse:
+        try:
+            return await self._client_session.ws_connect(_REALTIME_PATH, headers=self._upstream_headers(), params=self._upstream_params,
+                                                         max_msg_size=_WS_MAX_MSG_SIZE, heartbeat=_WS_HEARTBEAT, compress=_WS_COMPRESS)
+        except aiohttp.WSServerHandshakeError as e:
+            if e.status != 401 or self._credentials is None:
+                raise
+            # The cached token was rejected (revoked or expired early), get a new one and try once more
+            logger.info("Realtime API rejected the cached token, refreshing it")
+            await asyncio.get_running_loop().run_in_executor(None, self._refresh_token)
+            return await self._client_session.ws_connect(_REALTIME_PATH, headers=self._upstream_headers(), params=self._upstream_params,
+                                                         max_msg_size=_WS_MAX_MSG_SIZE, heartbeat=_WS_HEARTBEAT, compress=_WS_COMPRESS)
 
     async def _forward_messages(self, ws: web.WebSocketResponse):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = { "api-version": self.api_version, "deployment": self.deployment}
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = { "api-key": self.key }
-            else:
-                headers = { "Authorization": f"Bearer {self._token_provider()}" } # NOTE: no async version of token provider, maybe refresh token on a timer?
-            async with session.ws_connect("/openai/realtime", headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
-                            if new_msg is not None:
-                                await target_ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-                    
-                    # Means it is gracefully closed by the client then time to close the target_ws
-                    if target_ws:
-                        print("Closing OpenAI's realtime socket connection.")
-                        await target_ws.close()
-                        
-                async def from_server_to_client():
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(msg, ws, target_ws)
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-
-                try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+        target_ws = await self._connect_upstream()
+        conn = RTConnection(RTWebSocketWriter(ws, _CLIENT_MAX_PENDING), RTWebSocketWriter(target_ws, _SERVER_MAX_PENDING))
+        conn.client_ws.start()
+        conn.server_ws.start()
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self._from_client_to_server(ws, target_ws, conn))
+                tg.create_task(self._from_server_to_client(ws, target_ws, conn))
+        except* ConnectionResetError:
+            # Ignore the errors resulting from the client disconnecting the socket
+            pass
+        finally:
+            conn.cancel()
+            await target_ws.close()
 
     async def _websocket_handler(self, request: web.Request):
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(max_msg_size=_WS_MAX_MSG_SIZE, heartbeat=_WS_HEARTBEAT)
         await ws.prepare(request)
         await self._forward_messages(ws)
         return ws
     
     def attach_to_app(self, app, path):
         app.router.add_get(path, self._websocket_handler)
+        app.cleanup_ctx.append(self._client_session_ctx)
+        if self._credentials is not None:
+            app.cleanup_ctx.append(self._token_refresh_ctx)